@@ -3,7 +3,7 @@ import pytest
 from pytest import approx
 
 ## Tested data
-from eoiv_sorter.tool import eoiv_tool
+from eoiv_sorter.tool import eoiv_tool, probability_of_negative_IV, max_probability_of_negative_IV, factor_loadings_from_model_params, _negative_IV_quantiles
 
 from eoiv_sorter.utility import utility_model_list_to_model_dict, utility_model_json_to_model_dict, utility_model_dict_flatten_single_values
 
@@ -57,3 +57,180 @@ class TestToolRunUSDPreEndSept:
 			-0.137224884648809])
 
 		assert consts_array == approx(expected_consts), "All constants match expected values"
+
+## A synthetic, finer surface than the production grid
+def synthetic_factor_loadings():
+
+	rng = np.random.default_rng(2020)
+	index = pd.MultiIndex.from_product([np.arange(1, 31)/4, np.arange(50, 151)/100], names=['Maturity','Strike'])
+
+	return pd.DataFrame({
+		'IVInf': rng.uniform(0.1, 0.4, len(index)),
+		'LevelBeta': rng.uniform(0.5, 1.5, len(index)),
+		'SkewBeta': rng.uniform(-0.1, 0.1, len(index)),
+		'KurtosisBeta': rng.uniform(-0.1, 0.1, len(index)),
+		'TermStructureBeta': rng.uniform(-0.1, 0.1, len(index)),
+	}, index=index)
+
+## E_USD model parameters, with a synthetic surface that is finer than the production grid
+@pytest.fixture(scope='module')
+def model_params_and_factor_loadings():
+
+	with open(os.path.join(THIS_DIR,'E_USD_EndSep2020_Models.json')) as json_file:
+		dfdict = json.load(json_file)
+	model_dict = json.loads(dfdict['E_USD'])
+	model_params = {k:utility_model_json_to_model_dict(model_dict[k]) for k in model_dict}
+
+	return model_params, synthetic_factor_loadings()
+
+## E_USD factor loadings with gaps in the InitialIV surface, which give NaN nodes
+@pytest.fixture(scope='module')
+def E_USD_InitialIV_gaps(model_params_and_factor_loadings):
+
+	model_params, _ = model_params_and_factor_loadings
+
+	factor_loadings = factor_loadings_from_model_params(model_params)
+	factor_loadings.loc[[(0.25, 0.75), (3.0, 1.35)], 'InitialIV'] = np.nan
+
+	return factor_loadings
+
+## E_USD factor loadings where every InitialIV node is NaN
+@pytest.fixture(scope='module')
+def E_USD_InitialIV_all_missing(model_params_and_factor_loadings):
+
+	model_params, _ = model_params_and_factor_loadings
+
+	factor_loadings = factor_loadings_from_model_params(model_params)
+	factor_loadings['InitialIV'] = np.nan
+
+	return factor_loadings
+
+## Blockwise evaluation of the negative IV probabilities
+class TestProbabilityOfNegativeIVBlockwise:
+
+	def test_E_USD_maxnegativeIV(self, model_params_and_factor_loadings):
+
+		model_params, _ = model_params_and_factor_loadings
+		c_L = float(model_params['Settings']['ScalingFactor'])
+		factor_loadings = factor_loadings_from_model_params(model_params)
+
+		expected = approx(9.88072190993451e-11)
+
+		assert probability_of_negative_IV(c_L, model_params, factor_loadings)[0] == expected, "Probability output as expected"
+		assert probability_of_negative_IV(c_L, model_params, factor_loadings, memory_budget=2000)[0] == expected, "Probability output as expected with a small memory budget"
+
+	@pytest.mark.parametrize("c_L, expected", [(1.0, 1.0590426033969435e-24), (5.0, 0.21391782139230664)])
+	@pytest.mark.parametrize("memory_budget", [None, 2000])
+	def test_E_USD_InitialIV_gaps(self, model_params_and_factor_loadings, E_USD_InitialIV_gaps, c_L, expected, memory_budget):
+
+		model_params, _ = model_params_and_factor_loadings
+
+		result, _ = probability_of_negative_IV(c_L, model_params, E_USD_InitialIV_gaps, iv_column='InitialIV', memory_budget=memory_budget)
+
+		assert result == approx(expected, rel=1e-12), "NaN nodes do not change the maximum probability"
+
+	@pytest.mark.parametrize("memory_budget", [None, 2000])
+	def test_E_USD_InitialIV_all_missing(self, model_params_and_factor_loadings, E_USD_InitialIV_all_missing, memory_budget):
+
+		model_params, _ = model_params_and_factor_loadings
+
+		result, _ = probability_of_negative_IV(5.0, model_params, E_USD_InitialIV_all_missing, iv_column='InitialIV', memory_budget=memory_budget)
+
+		assert result == 0.0, "An all-NaN surface gives a probability of 0.0, as every NaN node summed to 0.0 in the original calculation"
+
+	def test_E_USD_non_divisor_step_size(self, model_params_and_factor_loadings):
+
+		model_params, _ = model_params_and_factor_loadings
+		c_L = float(model_params['Settings']['ScalingFactor'])
+		factor_loadings = factor_loadings_from_model_params(model_params)
+
+		# 0.03 does not divide 1, the grid is [0.03, 0.06, ..., 0.99]
+		assert len(_negative_IV_quantiles(1.0, 1.0, 0.03)) == 33, "Every multiple of step_size below 1 is in the grid"
+
+		result, _ = probability_of_negative_IV(c_L, model_params, factor_loadings, step_size=0.03)
+
+		assert result == approx(1.4500752165268767e-10, rel=1e-12), "Probability output as expected for a step_size that does not divide 1"
+
+	@pytest.mark.parametrize("step_size", [0, -0.01, 1, 1.5])
+	def test_step_size_out_of_range(self, model_params_and_factor_loadings, step_size):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+
+		with pytest.raises(ValueError):
+			probability_of_negative_IV(5.0, model_params, synthetic_loadings, step_size=step_size)
+
+	def test_memory_budget_matches_single_block(self, model_params_and_factor_loadings):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+		expected, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings)
+		blockwise, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, memory_budget=10000)
+
+		assert blockwise == approx(expected, rel=1e-12), "Streaming over small node and quantile tiles gives the same maximum probability"
+
+	def test_memory_budget_fine_step_size(self, model_params_and_factor_loadings):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+		expected, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, step_size=1/1000)
+		blockwise, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, step_size=1/1000, memory_budget=10000)
+
+		assert blockwise == approx(expected, rel=1e-12), "Quantiles split across several tiles give the same maximum probability"
+
+	@pytest.mark.parametrize("memory_budget", [None, 100000])
+	def test_workers_match_single_process(self, model_params_and_factor_loadings, memory_budget):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+		expected, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, memory_budget=memory_budget)
+		parallel, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, memory_budget=memory_budget, n_workers=2)
+
+		assert parallel == approx(expected, rel=1e-12), "Spreading node tiles across worker processes gives the same maximum probability"
+
+
+## Max-only evaluation of the negative IV probabilities
+class TestMaxProbabilityOfNegativeIV:
+
+	@pytest.mark.parametrize("c_L", [0.5, 1.0, 2.0, 5.0, 20.0])
+	def test_max_matches_full_integration(self, model_params_and_factor_loadings, c_L):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+		expected, expected_udc = probability_of_negative_IV(c_L, model_params, synthetic_loadings)
+		pruned, _, udc = max_probability_of_negative_IV(c_L, model_params, synthetic_loadings)
+
+		assert pruned == expected, "Pruning nodes by their bounds gives exactly the fully integrated maximum"
+		assert udc == expected_udc, "The used derived constants are unchanged"
+
+	@pytest.mark.parametrize("c_L", [0.5, 5.0])
+	def test_max_node(self, model_params_and_factor_loadings, c_L):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+		pruned, max_node, _ = max_probability_of_negative_IV(c_L, model_params, synthetic_loadings)
+		node_pd, _ = probability_of_negative_IV(c_L, model_params, synthetic_loadings.loc[[max_node]])
+
+		assert node_pd == pruned, "The maximum occurs at the returned (Maturity, Strike) node"
+
+	@pytest.mark.parametrize("c_L, expected_node", [(1.0, (5.0, 1.2)), (5.0, (0.25, 0.95))])
+	def test_E_USD_InitialIV_gaps(self, model_params_and_factor_loadings, E_USD_InitialIV_gaps, c_L, expected_node):
+
+		model_params, _ = model_params_and_factor_loadings
+
+		_, max_node, _ = max_probability_of_negative_IV(c_L, model_params, E_USD_InitialIV_gaps, iv_column='InitialIV')
+
+		assert max_node == expected_node, "NaN nodes do not change the node of the maximum"
+
+	def test_E_USD_InitialIV_all_missing(self, model_params_and_factor_loadings, E_USD_InitialIV_all_missing):
+
+		model_params, _ = model_params_and_factor_loadings
+
+		pruned, max_node, _ = max_probability_of_negative_IV(5.0, model_params, E_USD_InitialIV_all_missing, iv_column='InitialIV')
+
+		assert pruned == 0.0, "An all-NaN surface gives a probability of 0.0, as in probability_of_negative_IV"
+		assert max_node is None, "An all-NaN surface has no node of the maximum"
+
+	@pytest.mark.parametrize("step_size", [0.7, 1 - 1e-12])
+	def test_coarse_step_size(self, model_params_and_factor_loadings, step_size):
+
+		model_params, synthetic_loadings = model_params_and_factor_loadings
+
+		expected, _ = probability_of_negative_IV(5.0, model_params, synthetic_loadings, step_size=step_size)
+		pruned, _, _ = max_probability_of_negative_IV(5.0, model_params, synthetic_loadings, step_size=step_size)
+
+		assert pruned == expected, "A grid with one or no quantiles gives the fully integrated maximum"
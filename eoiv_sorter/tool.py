@@ -2,6 +2,8 @@ import pandas as pd
 import json
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from scipy.interpolate import interp1d
 from scipy.stats import norm, gamma
 
@@ -47,35 +49,160 @@ def skt_smoothing(factor_loadings):
     
     return SKT_Smoothed
 
-def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', step_size = 1/100):
-    """ Calculation of the probablities of negative IVs being produced by the model. See https://erswiki.analytics.moodys.net/display/EI/Standard+calibration+of+the+real-world+equity+implied+volatility+model for the definition of the analytic derivation of the negative rate probablilities.  
+# Each (nodes x quantiles) element of a block is held in a few float64 temporaries at once (threshold, its intermediate products, cdf)
+_BLOCK_BYTES_PER_ELEMENT = 8 * 4
+
+def _negative_IV_block_shape(n_nodes, n_quantiles, memory_budget):
+    """ Returns the (node_block, quantile_block) tile sizes that keep the working block within 'memory_budget' bytes. Whole quantile rows are preferred, so that per-node sums are built from as few tiles as possible.
+    """
+    if memory_budget is None:
+        return max(n_nodes, 1), max(n_quantiles, 1)
+
+    elements = max(int(memory_budget) // _BLOCK_BYTES_PER_ELEMENT, 1)
+    quantile_block = max(min(n_quantiles, elements), 1)
+    node_block = max(min(n_nodes, elements // quantile_block), 1)
+
+    return node_block, quantile_block
+
+def _negative_IV_quantiles(gamma_k, gamma_theta, step_size):
+    """ Returns the gamma quantiles of the variance at the percentages [step_size, 2*step_size, ...] that lie strictly below 1. This is only 1-D in the quantiles, so it is computed once and shared by every node tile.
+    """
+    if not 0 < step_size < 1:
+        raise ValueError(f"step_size must lie in (0, 1), got {step_size}")
+
+    # Count the multiples of step_size strictly below 1, allowing for rounding when step_size divides 1
+    n_quantiles = int(np.ceil(1 / step_size - 1e-9)) - 1
+    pct = np.arange(1, n_quantiles + 1) * step_size
+
+    return gamma.ppf(pct, a=gamma_k, scale=gamma_theta)
+
+def _negative_IV_node_tile(IV, Lv, beta_2, y, c_L, parameter_a, parameter_b, step_size, quantile_block):
+    """ Returns the cumulative negative IV probability of each node in a tile of nodes, streaming over the quantiles 'y' in tiles of 'quantile_block'. Only the running per-node sums and a single (nodes x quantile_block) block are held in memory.
+    """
+    IV = IV[:, np.newaxis]
+    level = c_L * Lv[:, np.newaxis]
+    beta_2 = beta_2[:, np.newaxis]
+
+    cumulative_pd = np.zeros(IV.shape[0])
+    for start in range(0, len(y), quantile_block):
+        y_tile = y[start:start + quantile_block]
+        threshold = (IV + level * ((parameter_a + y_tile)**0.5 + parameter_b)) * -1 / beta_2
+        cumulative_pd += (step_size * norm.cdf(threshold)).sum(axis=1)
+
+    return cumulative_pd
+
+def _negative_IV_no_finite_node(n_nodes):
+    """ Returns the (maximum, node position) result when none of the 'n_nodes' nodes has a finite sum. A NaN node summed to 0.0 in the original pandas calculation (the sum skips NaN), so the maximum is 0.0 with no node, or NaN if the surface has no nodes at all.
+    """
+    return (0.0 if n_nodes > 0 else np.nan), None
+
+def _negative_IV_blockwise_max(c_L, parameter_a, parameter_b, gamma_k, gamma_theta, IV, Lv, beta_2, step_size, memory_budget=None, n_workers=1):
+    """ Returns the maximum cumulative negative IV probability across the nodes given as arrays 'IV', 'Lv' and 'beta_2', together with the position of the node it occurs at. Nodes whose sum is NaN are skipped, see '_negative_IV_no_finite_node' for the result when no node is left. Nodes are evaluated in tiles sized by '_negative_IV_block_shape' and a running maximum is kept, so peak memory is bounded by 'memory_budget' rather than by the grid resolution. With 'n_workers' > 1 the nodes are split into at least 'n_workers' tiles, which are spread across worker processes.
+    """
+    n_nodes = len(IV)
+    y = _negative_IV_quantiles(gamma_k, gamma_theta, step_size)
+    node_block, quantile_block = _negative_IV_block_shape(n_nodes, len(y), memory_budget)
+
+    # Give every worker at least one tile, also when the whole surface fits in a single block
+    if n_workers > 1:
+        node_block = max(min(node_block, -(-n_nodes // n_workers)), 1)
+
+    tile_fcn = partial(_negative_IV_node_tile,
+        y=y, c_L=c_L, parameter_a=parameter_a, parameter_b=parameter_b,
+        step_size=step_size, quantile_block=quantile_block)
+
+    starts = range(0, n_nodes, node_block)
+    tiles = ((IV[i:i + node_block], Lv[i:i + node_block], beta_2[i:i + node_block]) for i in starts)
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            tile_pds = list(executor.map(tile_fcn, *zip(*tiles)))
+    else:
+        tile_pds = (tile_fcn(*tile) for tile in tiles)
+
+    # Nodes with a NaN sum (e.g. gaps in the IV surface) are skipped
+    max_pd, max_node = np.nan, None
+    for start, tile_pd in zip(starts, tile_pds):
+        if np.isnan(tile_pd).all():
+            continue
+        tile_max = np.nanargmax(tile_pd)
+        if max_node is None or tile_pd[tile_max] > max_pd:
+            max_pd, max_node = tile_pd[tile_max], start + tile_max
+
+    if max_node is None:
+        return _negative_IV_no_finite_node(n_nodes)
+
+    return max_pd, max_node
+
+def _negative_IV_node_inputs(factor_loadings, iv_column):
+    """ Returns the IV surface, 'LevelBeta' and beta_2 (the norm of the SKT (Skew-Kurtosis-TermStructure) betas) of every node in 'factor_loadings' as numpy arrays.
+    """
+    SKT = factor_loadings[['SkewBeta','KurtosisBeta','TermStructureBeta']].apply(pd.to_numeric)
+    beta_2 = SKT.apply(lambda i:i**2).sum(axis=1).apply(lambda i: i**0.5)
 
-    Args: 
-        c_L: float. The scaling factor of the model.
-        mpd: dictonary. The *model-parameter* dictionary containing all parameters required from the input models.
-        factor_loadings: pandas table. Representing the Factor Loadings table of the model. This is derived during the tool run, and may be smoothed first using *skt_smoothing*.
-        iv_column: string, defaults to 'IVInf'. The column in 'factor_loadings' that will be used as the volatility surface in the calculation. This should be 'IVInf' or 'InitialIV'.
-        step_size: float, default 1/100. The granularity of the percentages where we will evaluate the negative rate probablities. At the default level this will calculate probablilites at [0.01, 0.02, ..., 0.98, 0.99]
+    IV = factor_loadings[iv_column].astype(float).to_numpy()
+    Lv = factor_loadings['LevelBeta'].astype(float).to_numpy()
 
-    Returns:
+    return IV, Lv, beta_2.to_numpy()
 
-        An unnamed tuple containing the results:
-        [0], float: The maximum negative rate probablilty. This is the maximum value of the observed cumulative probablilty across all terms and strikes in the IV surface.
-        [1], dictionary: A table of  the *used derived constants* calcluated in the process of calculating negative IV probablities. This can be used to check calculated values.  
-        
-        udc = {
-            'gamma_k':gamma_k,
-            'gamma_theta':gamma_theta,        
-            'sigma_J2':sigma_J2,
-            'sys_vol': sys_vol,
-            'variance_mean': variance_mean,
-            'variance_var': variance_var,
-            'nu_infty':nu_infty,
-            'parameter_a': parameter_a,
-            'parameter_b': parameter_b        
-        }
-               
-    """    
+# Relative slack on the node bounds, so that rounding in the full integration can never push a node outside its bounds
+_BOUND_TOLERANCE = 1e-9
+
+def _negative_IV_node_bounds(c_L, parameter_a, parameter_b, IV, Lv, beta_2, y, step_size):
+    """ Returns (lower, upper) bounds on the cumulative negative IV probability of each node. The threshold is monotonic in the gamma quantile, so every term of the sum lies between its values at the two extreme quantiles of 'y'.
+    """
+    y_extreme = y[[0, -1]]
+    threshold = (IV[:, np.newaxis] + c_L * Lv[:, np.newaxis] * ((parameter_a + y_extreme)**0.5 + parameter_b)) * -1 / beta_2[:, np.newaxis]
+    extreme_pd = len(y) * step_size * norm.cdf(threshold)
+
+    # Nodes with no finite bound (e.g. a gap in the IV surface) keep NaN bounds, their full sum is NaN too
+    lower = extreme_pd.min(axis=1) * (1 - _BOUND_TOLERANCE)
+    upper = extreme_pd.max(axis=1) * (1 + _BOUND_TOLERANCE)
+
+    return lower, upper
+
+def _negative_IV_pruned_max(c_L, parameter_a, parameter_b, gamma_k, gamma_theta, IV, Lv, beta_2, step_size, memory_budget=None):
+    """ Returns the same maximum and node position as '_negative_IV_blockwise_max', fully integrating only the nodes that can hold the maximum. Nodes whose upper bound is below the best lower bound are pruned, and the rest are integrated in tiles in order of decreasing upper bound, stopping once no remaining node can beat the best value found so far. Nodes without finite bounds or a finite sum are skipped, and the result when no node is left is as in '_negative_IV_blockwise_max'.
+    """
+    y = _negative_IV_quantiles(gamma_k, gamma_theta, step_size)
+
+    # With no quantiles below 1 there is nothing to bound, every node sums to 0.0
+    if len(y) == 0:
+        return _negative_IV_blockwise_max(c_L, parameter_a, parameter_b, gamma_k, gamma_theta, IV, Lv, beta_2, step_size)
+
+    lower, upper = _negative_IV_node_bounds(c_L, parameter_a, parameter_b, IV, Lv, beta_2, y, step_size)
+
+    bounded = np.isfinite(lower) & np.isfinite(upper)
+    if not bounded.any():
+        return _negative_IV_no_finite_node(len(IV))
+
+    candidates = np.flatnonzero(bounded & (upper >= lower[bounded].max()))
+    candidates = candidates[np.argsort(-upper[candidates], kind='stable')]
+    node_block, quantile_block = _negative_IV_block_shape(len(candidates), len(y), memory_budget)
+
+    max_pd, max_node = np.nan, None
+    for start in range(0, len(candidates), node_block):
+        tile = candidates[start:start + node_block]
+        if max_node is not None and upper[tile[0]] < max_pd:
+            break
+
+        tile_pd = _negative_IV_node_tile(IV[tile], Lv[tile], beta_2[tile], y, c_L, parameter_a, parameter_b, step_size, quantile_block)
+
+        # Ties go to the first node on the surface, as in '_negative_IV_blockwise_max'
+        for node, node_pd in zip(tile, tile_pd):
+            if not np.isfinite(node_pd):
+                continue
+            if max_node is None or node_pd > max_pd or (node_pd == max_pd and node < max_node):
+                max_pd, max_node = node_pd, node
+
+    if max_node is None:
+        return _negative_IV_no_finite_node(len(IV))
+
+    return max_pd, max_node
+
+def _negative_IV_derived_constants(mpd):
+    """ Returns the *used derived constants* of the negative IV probability calculation from the *model-parameter* dictionary 'mpd'. See *probability_of_negative_IV* for the keys of the returned dictionary.
+    """
     # 1. Extract parameters from mpd dictionary
     
     F1_Var_RevLevel = float(mpd['F1.SVJD']['BE_SVJD_E_Var_RevLevel_F1'])
@@ -115,10 +242,6 @@ def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', ste
     factor_vars_2to5  = np.array([F2_Var,F3_Var,F4_Var,F5_Var,F6_Var])
     sys_vol = (asset_beta_2to5**2).dot(factor_vars_2to5)  
     
-    # Take SKT (Skew-Kurtosis-TermStructure) from the factor loadings
-    
-    SKT = factor_loadings[['SkewBeta','KurtosisBeta','TermStructureBeta']].apply(pd.to_numeric)
-    
     # 2. Calculate constant parameters
 
     gamma_k = ( 
@@ -130,8 +253,6 @@ def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', ste
         ( Asset_Beta_1**4 * F1_Var_RevLevel * F1_Var_Vol**2 / (2*F1_Var_RevRate) + Asset_Var_RevLevel * Asset_Var_Vol**2/(2*Asset_Var_RevRate))
         / (Asset_Beta_1**2 * F1_Var_RevLevel + Asset_Var_RevLevel))
 
-    beta_2 = SKT.apply(lambda i:i**2).sum(axis=1).apply(lambda i: i**0.5)
-
     sigma_J2 = (
             0.25*F1_Jump_ArrivalRate*
             (Asset_Beta_1**2)*
@@ -178,24 +299,6 @@ def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', ste
     # calculating parameter b of Section 5.8 of Wiki page
     parameter_b =-(sigma_J2+nu_infty)**0.5
     
-    # 3. calculate negative IV
-    
-    IV = factor_loadings[iv_column].astype(float)
-    Lv = factor_loadings['LevelBeta'].astype(float)
-
-    def thresholdFcn(y):
-        return (IV.add(c_L*Lv*((parameter_a + y)**0.5 + parameter_b))*-1)/beta_2
-
-    pct_range = [i * step_size for i in range(1,100)]
-    actual_pd = pd.DataFrame()
-    for p in pct_range:
-        actual_pd[p] = step_size * thresholdFcn(gamma.ppf(p, a=gamma_k, scale=gamma_theta)).apply(norm.cdf)
-
-    cumulative_pd = actual_pd.sum(axis=1)
-
-    probability_of_negative_IV = cumulative_pd.max()
-    
-    # Return the used derived constants
     udc = {
         'gamma_k':gamma_k,
         'gamma_theta':gamma_theta,        
@@ -207,25 +310,101 @@ def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', ste
         'parameter_a': parameter_a,
         'parameter_b': parameter_b        
     }
+
+    return udc
+
+def probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', step_size = 1/100, memory_budget=None, n_workers=1):
+    """ Calculation of the probablities of negative IVs being produced by the model. See https://erswiki.analytics.moodys.net/display/EI/Standard+calibration+of+the+real-world+equity+implied+volatility+model for the definition of the analytic derivation of the negative rate probablilities.  
+
+    Args: 
+        c_L: float. The scaling factor of the model.
+        mpd: dictonary. The *model-parameter* dictionary containing all parameters required from the input models.
+        factor_loadings: pandas table. Representing the Factor Loadings table of the model. This is derived during the tool run, and may be smoothed first using *skt_smoothing*.
+        iv_column: string, defaults to 'IVInf'. The column in 'factor_loadings' that will be used as the volatility surface in the calculation. This should be 'IVInf' or 'InitialIV'.
+        step_size: float, default 1/100. The granularity of the percentages where we will evaluate the negative rate probablities. At the default level this will calculate probablilites at [0.01, 0.02, ..., 0.98, 0.99]. Every multiple of 'step_size' strictly below 1 is used, and a ValueError is raised if 'step_size' is not in (0, 1).
+        memory_budget: int, optional. The approximate number of bytes the working (nodes x quantiles) block may use. If None, all nodes and quantiles are evaluated in a single block. Set this for very fine strike and maturity grids or small 'step_size', where the full block would not fit in memory. The result does not depend on this setting.
+        n_workers: int, default 1. The number of worker processes the nodes are spread across. The nodes are split into at least 'n_workers' blocks, also when 'memory_budget' is None. With the default of 1 the blocks are evaluated in this process.
+
+    Returns:
+
+        An unnamed tuple containing the results:
+        [0], float: The maximum negative rate probablilty. This is the maximum value of the observed cumulative probablilty across all terms and strikes in the IV surface.
+        [1], dictionary: A table of  the *used derived constants* calcluated in the process of calculating negative IV probablities. This can be used to check calculated values.  
+        
+        udc = {
+            'gamma_k':gamma_k,
+            'gamma_theta':gamma_theta,        
+            'sigma_J2':sigma_J2,
+            'sys_vol': sys_vol,
+            'variance_mean': variance_mean,
+            'variance_var': variance_var,
+            'nu_infty':nu_infty,
+            'parameter_a': parameter_a,
+            'parameter_b': parameter_b        
+        }
+               
+    """    
+    # 1. Calculate the used derived constants from the mpd dictionary
     
-    return probability_of_negative_IV, udc
+    udc = _negative_IV_derived_constants(mpd)
+
+    # 2. Take IV, LevelBeta and beta_2 from the factor loadings
     
-def eoiv_tool(model_dict):
-    """ A "sorter" style tool that produces a valid 'Assets.EQ.PEA.RWOIV' model as its sole output model. This is compiled from the input Models passed in a 'model_dict' of compiled models. In addition to the 'Assets.EQ.PEA.RWOIV' model parameters, we also calculate the expected maximum negative rate probablities based on the current and unconditional IV surfaces.  
+    IV, Lv, beta_2 = _negative_IV_node_inputs(factor_loadings, iv_column)
+    
+    # 3. calculate negative IV
+
+    probability_of_negative_IV, _ = _negative_IV_blockwise_max(
+        c_L, udc['parameter_a'], udc['parameter_b'], udc['gamma_k'], udc['gamma_theta'],
+        IV, Lv, beta_2, step_size,
+        memory_budget=memory_budget, n_workers=n_workers)
+    
+    return probability_of_negative_IV, udc
+
+def max_probability_of_negative_IV(c_L, mpd, factor_loadings, iv_column='IVInf', step_size = 1/100, memory_budget=None):
+    """ Calculation of the maximum probablity of negative IVs being produced by the model, and the node of the IV surface where it occurs. This gives the same maximum as *probability_of_negative_IV*, but first bounds every node using the extreme quantiles and only fully integrates the nodes that can hold the maximum. This is much faster on large surfaces, or when sweeping over 'c_L'.
 
     Args: 
-        model_dict: dictionary. A dictionary representation of "input" models to a tool. The "anchored" model names are the keys in the dictionary, and the returned values are string representations of the Model JSON for each model. 
+        c_L: float. The scaling factor of the model.
+        mpd: dictonary. The *model-parameter* dictionary containing all parameters required from the input models.
+        factor_loadings: pandas table. Representing the Factor Loadings table of the model. This is derived during the tool run, and may be smoothed first using *skt_smoothing*.
+        iv_column: string, defaults to 'IVInf'. The column in 'factor_loadings' that will be used as the volatility surface in the calculation. This should be 'IVInf' or 'InitialIV'.
+        step_size: float, default 1/100. The granularity of the percentages where we will evaluate the negative rate probablities. At the default level this will calculate probablilites at [0.01, 0.02, ..., 0.98, 0.99]. Every multiple of 'step_size' strictly below 1 is used, and a ValueError is raised if 'step_size' is not in (0, 1).
+        memory_budget: int, optional. The approximate number of bytes the working (nodes x quantiles) block may use. See *probability_of_negative_IV*.
 
     Returns:
 
-        An output dictionary of "anchored" model names and Model JSON values. The dictionary contains a single key 'Output'. This can be pushed as a valid 'Assets.EQ.PEA.RWOIV' model.
+        An unnamed tuple containing the results:
+        [0], float: The maximum negative rate probablilty. This is the maximum value of the observed cumulative probablilty across all terms and strikes in the IV surface.
+        [1], tuple: The (Maturity, Strike) index of the node in 'factor_loadings' where the maximum occurs. If several nodes share the maximum, the first is returned.
+        [2], dictionary: A table of  the *used derived constants* calcluated in the process of calculating negative IV probablities. See *probability_of_negative_IV*.
                
-    """      
-    # Extract model dictionary to a model-parameter dictionary
-    model_params = {k:utility_model_json_to_model_dict(model_dict[k]) for k in model_dict}
+    """
+    udc = _negative_IV_derived_constants(mpd)
+
+    IV, Lv, beta_2 = _negative_IV_node_inputs(factor_loadings, iv_column)
+
+    max_probability_of_negative_IV, max_node = _negative_IV_pruned_max(
+        c_L, udc['parameter_a'], udc['parameter_b'], udc['gamma_k'], udc['gamma_theta'],
+        IV, Lv, beta_2, step_size,
+        memory_budget=memory_budget)
+
+    if max_node is not None:
+        max_node = factor_loadings.index[max_node]
+
+    return max_probability_of_negative_IV, max_node, udc
     
-    # Get settings values
-    c_L = float(model_params['Settings']['ScalingFactor'])
+def factor_loadings_from_model_params(model_params):
+    """ Compiles the Factor Loadings table of the model from the *model-parameter* dictionary of the input models. This joins the 'InitialIV' surface to the 'RWOIV.Betas' factor loadings, and applies *skt_smoothing* if the 'ApplySmoothing' setting is on.
+
+    Args: 
+        model_params: dictonary. The *model-parameter* dictionary containing all parameters required from the input models.
+
+    Returns:
+
+        A pandas table representing the Factor Loadings table, indexed by 'Maturity' and 'Strike', with the 'InitialIV','IVInf','LevelBeta','SkewBeta','KurtosisBeta' & 'TermStructureBeta' columns.
+               
+    """
     apply_smoothing = bool(model_params['Settings']['ApplySmoothing'])
     
     # The parameters can then be read from the dictionary, and converted to data types for use in python (tables or single values)
@@ -254,6 +433,27 @@ def eoiv_tool(model_dict):
         factor_loadings['KurtosisBeta'] = skt_smoothed['SmooKurtosisBeta']
         factor_loadings['TermStructureBeta'] = skt_smoothed['SmooTermStructureBeta']
 
+    return factor_loadings
+    
+def eoiv_tool(model_dict):
+    """ A "sorter" style tool that produces a valid 'Assets.EQ.PEA.RWOIV' model as its sole output model. This is compiled from the input Models passed in a 'model_dict' of compiled models. In addition to the 'Assets.EQ.PEA.RWOIV' model parameters, we also calculate the expected maximum negative rate probablities based on the current and unconditional IV surfaces.  
+
+    Args: 
+        model_dict: dictionary. A dictionary representation of "input" models to a tool. The "anchored" model names are the keys in the dictionary, and the returned values are string representations of the Model JSON for each model. 
+
+    Returns:
+
+        An output dictionary of "anchored" model names and Model JSON values. The dictionary contains a single key 'Output'. This can be pushed as a valid 'Assets.EQ.PEA.RWOIV' model.
+               
+    """      
+    # Extract model dictionary to a model-parameter dictionary
+    model_params = {k:utility_model_json_to_model_dict(model_dict[k]) for k in model_dict}
+    
+    # Get settings values
+    c_L = float(model_params['Settings']['ScalingFactor'])
+    
+    factor_loadings = factor_loadings_from_model_params(model_params)
+
     # Convert to a suitable table for parameter export
     factor_loadings_parameter = factor_loadings.reset_index().sort_values(['Maturity','Strike'])
     factor_loadings_parameter['_index'] = factor_loadings_parameter.index + 1
@@ -261,8 +461,8 @@ def eoiv_tool(model_dict):
     
     # Calculate default probability at given scaling factor       
     
-    PONIV_IVInf, constants = probability_of_negative_IV(c_L, model_params, factor_loadings, iv_column='IVInf', step_size = 1/100)
-    PONIV_IV_InitialIV, _ = probability_of_negative_IV(c_L, model_params, factor_loadings, iv_column='InitialIV', step_size = 1/100)
+    PONIV_IVInf, _, constants = max_probability_of_negative_IV(c_L, model_params, factor_loadings, iv_column='IVInf', step_size = 1/100)
+    PONIV_IV_InitialIV, _, _ = max_probability_of_negative_IV(c_L, model_params, factor_loadings, iv_column='InitialIV', step_size = 1/100)
     
     constants_parameter = pd.Series(constants, name='Value').rename_axis('Name').reset_index().to_dict('records')
     